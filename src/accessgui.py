@@ -6,50 +6,328 @@ Access-Aide GUI with optional AI-assisted ALT autofill
 """
 import sys
 import os
+import re
 import base64
+import mmap
 import json
+import time
+import logging
+import threading
+import http.client
 import urllib.request
-import urllib.error
+from urllib.parse import urlparse, unquote
+from functools import lru_cache
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from plugin_utils import QtCore, QtGui, QtWidgets, QtSvg
-from quickparser import QuickXHTMLParser
+# use the much faster orjson to decode api responses when it is available
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
+from plugin_utils import QtCore, QtGui, QtWidgets, QtSvg, Signal
+
+# autofill logging is quiet (warnings only) unless ACCESS_AIDE_DEBUG is set,
+# as writing to stdout from every worker would serialize the requests
+_log = logging.getLogger('access_aide')
+if not _log.handlers:
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(logging.Formatter('[Access-Aide] %(message)s'))
+    _log.addHandler(_handler)
+    _log.propagate = False
+_log.setLevel(logging.DEBUG if os.getenv('ACCESS_AIDE_DEBUG') else logging.WARNING)
 
 _THUMBNAIL_SIZE_INCREMENT = 50
+_THUMBNAIL_RESIZE_DELAY = 100
+_THUMBNAIL_SMOOTH_DELAY = 250
+# largest edge kept for the images thumbnails are scaled from, and how many
+# of them are kept (at most about 4 MB each)
+_THUMBNAIL_BASE_MAX_EDGE = 1024
+_THUMBNAIL_BASE_CACHE_SIZE = 64
 _COL_ALTTEXT = 2
 
+# --- AI Request Settings ---
+_AI_MAX_WORKERS = 10
+_AI_MAX_ATTEMPTS = 3
+_AI_RETRY_STATUS = (429, 500, 502, 503, 504)
+_AI_BATCH_SIZE = 6
+_AI_API_HOST = 'api.openai.com'
+_AI_API_PATH = '/v1/responses'
+_AI_TIMEOUT = 30
+_AI_MAX_EDGE = 1024
+_AI_JPEG_QUALITY = 85
+_AI_PROMPT = "descrivi l'immagine per compilare l'attributo ALT html"
+_AI_BATCH_PROMPT = (
+    "descrivi ciascuna immagine per compilare l'attributo ALT html. "
+    "Rispondi solo con un array JSON di stringhe, una per immagine, nello stesso ordine."
+)
+
+# --- AI Payload Template ---
+# the request body is constant apart from the images, so serialize the
+# fixed parts once and only splice the base64 data urls in per request
+_AI_PAYLOAD_PREFIX = b'{"model":"gpt-4o-mini","input":[{"role":"user","content":['
+_AI_PAYLOAD_SUFFIX = b']}]}'
+_AI_IMAGE_PREFIX = b'{"type":"input_image","image_url":"'
+_AI_IMAGE_SUFFIX = b'"}'
+_AI_PROMPT_PART = json.dumps({"type": "input_text", "text": _AI_PROMPT}).encode()
+_AI_BATCH_PROMPT_PART = json.dumps({"type": "input_text", "text": _AI_BATCH_PROMPT}).encode()
+
 # --- SVG Rendering Helpers ---
+# desc, title and flowRoot elements (with their content) confuse QSvgRenderer
+_SVG_STRIP_RE = re.compile(
+    rb'<(desc|title|flowroot)\b(?:[^>]*?/>|[^>]*>.*?</\1\s*>)',
+    re.IGNORECASE | re.DOTALL
+)
+
+
 def FixupSvgForRendering(data):
-    svgdata = []
-    qp = QuickXHTMLParser()
-    qp.setContent(data)
-    skip = False
-    for (text, tpath, tname, ttype, tattr) in qp.parse_iter():
-        if tname and tname.lower() in ['desc', 'title', 'flowroot', 'flowRoot']:
-            if ttype == 'single':
-                continue
-            skip = (ttype == 'begin')
-            if ttype == 'end':
-                skip = False
-            continue
-        if not skip:
-            svgdata.append(text or qp.tag_info_to_xml(tname, ttype, tattr))
-    return ''.join(svgdata)
+    # works directly on the raw svg bytes in a single pass
+    return _SVG_STRIP_RE.sub(b'', data)
 
 
-def RenderSvgToImage(fpath):
+def _file_mtime(fpath):
+    try:
+        return os.path.getmtime(fpath)
+    except OSError:
+        return None
+
+
+@lru_cache(maxsize=256)
+def _cached_fixed_svg(fpath, mtime):
     with open(fpath, 'rb') as f:
-        svgdat = f.read().decode('utf-8', errors='replace')
-    svgdata = FixupSvgForRendering(svgdat)
-    renderer = QtSvg.QSvgRenderer()
-    renderer.load(svgdata.encode('utf-8'))
+        return FixupSvgForRendering(f.read())
+
+
+# QSvgRenderer is a QObject so every thread (gui and thumbnail workers)
+# keeps and reuses its own instance
+_svg_tls = threading.local()
+
+
+def _svg_renderer():
+    renderer = getattr(_svg_tls, 'renderer', None)
+    if renderer is None:
+        renderer = QtSvg.QSvgRenderer()
+        _svg_tls.renderer = renderer
+    return renderer
+
+
+def RenderSvgToImage(fpath):
+    svgdata = _cached_fixed_svg(fpath, _file_mtime(fpath))
+    renderer = _svg_renderer()
+    renderer.load(svgdata)
     sz = renderer.defaultSize()
-    image = QtGui.QImage(sz, QtGui.QImage.Format_ARGB32)
+    # the svg is composited over an opaque white background so no alpha
+    # channel is needed, and RGB32 is a format QPainter draws onto natively
+    image = QtGui.QImage(sz, QtGui.QImage.Format_RGB32)
     image.fill(QtGui.QColor('white'))
     painter = QtGui.QPainter(image)
     renderer.render(painter)
+    painter.end()
     return image
 
 
+def DecodeImage(apath, mime):
+    if mime == 'image/svg+xml':
+        return RenderSvgToImage(apath)
+    return QtGui.QImage(apath)
+
+
+def _decode_base_image(apath, mime):
+    img = DecodeImage(apath, mime)
+    if max(img.width(), img.height()) > _THUMBNAIL_BASE_MAX_EDGE:
+        img = img.scaled(
+            _THUMBNAIL_BASE_MAX_EDGE, _THUMBNAIL_BASE_MAX_EDGE,
+            QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation
+        )
+    return img
+
+
+# base images are cached so thumbnail resizes only need to rescale, both
+# their size and their number are capped so memory stays bounded however
+# many images the book has, the thumbnail workers decode on a miss while
+# the gui thread only ever looks up what is already there
+class _BaseImageCache(object):
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._images = OrderedDict()
+
+    def get(self, apath, mime):
+        with self._lock:
+            entry = self._images.get((apath, mime))
+            if entry is None:
+                return None
+            self._images.move_to_end((apath, mime))
+            return entry[1]
+
+    def load(self, apath, mime):
+        key = (apath, mime)
+        mtime = _file_mtime(apath)
+        with self._lock:
+            entry = self._images.get(key)
+            if entry is not None and entry[0] == mtime:
+                self._images.move_to_end(key)
+                return entry[1]
+        img = _decode_base_image(apath, mime)
+        with self._lock:
+            self._images[key] = (mtime, img)
+            self._images.move_to_end(key)
+            while len(self._images) > self.maxsize:
+                self._images.popitem(last=False)
+        return img
+
+
+_BASE_IMAGES = _BaseImageCache(_THUMBNAIL_BASE_CACHE_SIZE)
+
+
+def LoadBaseImage(apath, mime):
+    return _BASE_IMAGES.load(apath, mime)
+
+
+# --- Thumbnail Workers ---
+class ThumbnailSignals(QtCore.QObject):
+    # row, thumbnail size, size capped base QImage, scaled QImage
+    done = Signal(int, int, object, object)
+
+
+class ThumbnailRunnable(QtCore.QRunnable):
+    # QImage (unlike QPixmap) may be used outside the gui thread, the
+    # scaled image is turned into a QPixmap once it reaches the gui thread
+    def __init__(self, row, apath, mime, size, signals):
+        super().__init__()
+        self.row = row
+        self.apath = apath
+        self.mime = mime
+        self.size = size
+        self.signals = signals
+
+    def run(self):
+        base = LoadBaseImage(self.apath, self.mime)
+        img = base.scaled(
+            self.size, self.size,
+            QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation
+        )
+        self.signals.done.emit(self.row, self.size, base, img)
+
+
+# --- AI Response Helpers ---
+def _clip_alt(desc):
+    desc = desc.strip()
+    return desc if len(desc) <= 400 else desc[:397] + '...'
+
+
+def _parse_alt_list(text, count):
+    # replies are matched to images by position, so anything but a json
+    # list of exactly count entries is rejected (None) rather than guessed at
+    # models often wrap json in a markdown code fence so strip it first
+    text = text.strip()
+    if text.startswith('```'):
+        text = text.strip('`')
+        if text.startswith('json'):
+            text = text[4:]
+    try:
+        alts = _loads(text)
+    except ValueError:
+        return None
+    if not isinstance(alts, list) or len(alts) != count:
+        return None
+    # a null or object entry is no more usable than a missing one
+    if not all(isinstance(a, str) for a in alts):
+        return None
+    return alts
+
+
+# --- AI Image Encoding ---
+# vision models never look at more than ~1024px so downscale and send a
+# compact jpeg instead of the raw (possibly multi-MB) file
+def _encode_image_for_api(path, mime, max_edge=_AI_MAX_EDGE):
+    # decoded outside the thumbnail cache so each full size upload
+    # is released as soon as it has been scaled down and encoded
+    img = DecodeImage(path, mime)
+    if img.isNull():
+        return None
+    if max(img.width(), img.height()) > max_edge:
+        img = img.scaled(
+            max_edge, max_edge,
+            QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation
+        )
+    if img.hasAlphaChannel():
+        # jpeg has no alpha so flatten onto white like the svg thumbnails
+        flat = QtGui.QImage(img.size(), QtGui.QImage.Format_RGB32)
+        flat.fill(QtGui.QColor('white'))
+        painter = QtGui.QPainter(flat)
+        painter.drawImage(0, 0, img)
+        painter.end()
+        img = flat
+    qba = QtCore.QByteArray()
+    buf = QtCore.QBuffer(qba)
+    buf.open(QtCore.QIODevice.WriteOnly)
+    ok = img.save(buf, 'JPEG', _AI_JPEG_QUALITY)
+    buf.close()
+    if not ok:
+        return None
+    return base64.b64encode(bytes(qba))
+
+
+def _build_payload(urls, prompt_part):
+    # data urls only hold ascii mime and base64 characters, so they can be
+    # placed inside the json string without any escaping
+    parts = [_AI_IMAGE_PREFIX + url + _AI_IMAGE_SUFFIX for url in urls]
+    parts.append(prompt_part)
+    return _AI_PAYLOAD_PREFIX + b','.join(parts) + _AI_PAYLOAD_SUFFIX
+
+
+# --- AI Connection Pool ---
+# urllib opens a new TCP+TLS connection for every request, so keep a small
+# pool of persistent https connections that are reused by every worker
+class _ConnectionPool(object):
+    def __init__(self, host, timeout):
+        self.host = host
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._idle = []
+        # honour HTTPS_PROXY, NO_PROXY and the system proxy settings as urllib did
+        self.proxy = urllib.request.getproxies().get('https')
+        if self.proxy and urllib.request.proxy_bypass(host):
+            self.proxy = None
+
+    def _connect(self):
+        if not self.proxy:
+            return http.client.HTTPSConnection(self.host, timeout=self.timeout)
+        purl = urlparse(self.proxy if '://' in self.proxy else 'http://' + self.proxy)
+        # a proxy without a port gets the https default, just like urllib
+        conn = http.client.HTTPSConnection(purl.hostname, purl.port, timeout=self.timeout)
+        headers = {}
+        if purl.username:
+            creds = unquote(purl.username) + ':' + unquote(purl.password or '')
+            headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(creds.encode()).decode('ascii')
+        conn.set_tunnel(self.host, headers=headers)
+        return conn
+
+    def acquire(self, fresh=False):
+        # returns (connection, reused), fresh skips the idle connections
+        if not fresh:
+            with self._lock:
+                if self._idle:
+                    return self._idle.pop(), True
+        return self._connect(), False
+
+    def release(self, conn):
+        with self._lock:
+            self._idle.append(conn)
+
+    def discard(self, conn):
+        conn.close()
+
+
+_AI_POOL = _ConnectionPool(_AI_API_HOST, _AI_TIMEOUT)
+
+# what a pooled connection the server has already closed fails with
+_STALE_CONN_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+
+
 class AltTextDelegate(QtWidgets.QStyledItemDelegate):
     def __init__(self, parent):
         super().__init__(parent)
@@ -78,6 +356,11 @@ class AltTextEditor(QtWidgets.QDialog):
         self.resources = resources
         self.ThumbnailSize = thumbnail_size
         self.altdata = {}
+        # the (imgbookpath, bookpath, imgcnt) key of each row, kept on the
+        # python side since Qt may not round trip a tuple through item data
+        self._rowkeys = []
+        # rows whose thumbnail has been set, their base images live in _BASE_IMAGES
+        self._thumbnailed = set()
         self.said_ok = False
         self.setWindowTitle('Update Alt for Each Image')
 
@@ -86,12 +369,20 @@ class AltTextEditor(QtWidgets.QDialog):
         self.editModel.itemChanged.connect(self.UpdateAltTextForItem)
         self.altDelegate = AltTextDelegate(self)
 
+        # Thumbnails are rendered off the gui thread
+        self.thumbSignals = ThumbnailSignals(self)
+        self.thumbSignals.done.connect(self.SetThumbnail)
+
         # Tree View
         self.imageTree = QtWidgets.QTreeView(self)
         self.imageTree.setItemDelegateForColumn(_COL_ALTTEXT, self.altDelegate)
         self.imageTree.setModel(self.editModel)
         self.imageTree.setWordWrap(True)
         self.imageTree.setEditTriggers(QtWidgets.QAbstractItemView.DoubleClicked)
+        # thumbnails are only decoded once their row scrolls into view
+        self._decoded = set()
+        self._ensurePending = False
+        self.imageTree.verticalScrollBar().valueChanged.connect(self._EnsureVisibleDecoded)
 
         # Buttons
         self.buttonBox = QtWidgets.QDialogButtonBox(
@@ -114,6 +405,14 @@ class AltTextEditor(QtWidgets.QDialog):
         inc = QtWidgets.QToolButton(self)
         inc.setText('+')
         inc.clicked.connect(self.IncreaseThumbnailSize)
+        # coalesce rapid +/- clicks into a single rescale
+        self._resizeTimer = QtCore.QTimer(self)
+        self._resizeTimer.setSingleShot(True)
+        self._resizeTimer.setInterval(_THUMBNAIL_RESIZE_DELAY)
+        self._resizeTimer.timeout.connect(self.UpdateThumbnails)
+        # resizes first use a fast draft scale, then a smooth pass when idle
+        self._draft = False
+        self._draftSize = None
         sizeLayout = QtWidgets.QHBoxLayout()
         sizeLayout.addWidget(lbl)
         sizeLayout.addWidget(dec)
@@ -131,69 +430,151 @@ class AltTextEditor(QtWidgets.QDialog):
     def sizeHint(self):
         return QtCore.QSize(1000, 800)
 
+    def showEvent(self, event):
+        super().showEvent(event)
+        # wait for the view to be laid out before checking what is visible
+        QtCore.QTimer.singleShot(0, self._EnsureVisibleDecoded)
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self._EnsureVisibleDecoded()
+
     def SetImages(self):
         self.editModel.clear()
+        self._thumbnailed = set()
+        self._decoded = set()
         self.editModel.setHorizontalHeaderLabels(['Path', 'Thumbnail', 'Alt Text'])
+        # one shared placeholder until each thumbnail worker finishes
+        # the model holds QPixmaps, a QImage decoration would be converted
+        # to a pixmap again on every paint and size hint of its row
+        thumb = QtGui.QPixmap(self.ThumbnailSize, self.ThumbnailSize)
+        thumb.fill(QtCore.Qt.transparent)
+        rows = []
+        self._rowkeys = []
         for (apath, bkpath, mime, key, atext) in self.resources:
             self.altdata[key] = atext
+            self._rowkeys.append(key)
             # Path item
             name = QtGui.QStandardItem(bkpath)
             name.setData(apath, QtCore.Qt.UserRole + 1)
             name.setData(mime, QtCore.Qt.UserRole + 2)
-            name.setData(key, QtCore.Qt.UserRole + 3)
             name.setEditable(False)
             # Thumbnail item
-            if mime == 'image/svg+xml':
-                img = RenderSvgToImage(apath)
-            else:
-                img = QtGui.QImage(apath)
-            pix = QtGui.QPixmap.fromImage(img).scaled(
-                self.ThumbnailSize, self.ThumbnailSize,
-                QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation
-            )
             icon = QtGui.QStandardItem()
-            icon.setData(pix, QtCore.Qt.DecorationRole)
+            icon.setData(thumb, QtCore.Qt.DecorationRole)
             icon.setEditable(False)
             # Alt Text item
             alt = QtGui.QStandardItem(atext)
             alt.setEditable(True)
-            self.editModel.appendRow([name, icon, alt])
+            rows.append((name, icon, alt))
+        # allocate every row at once, then fill the cells without any
+        # per item signals and let the view relayout a single time
+        self.editModel.setRowCount(len(rows))
+        self.editModel.blockSignals(True)
+        for r, row in enumerate(rows):
+            for c, item in enumerate(row):
+                self.editModel.setItem(r, c, item)
+        self.editModel.blockSignals(False)
+        self.editModel.layoutChanged.emit()
         header = self.imageTree.header()
         header.setStretchLastSection(True)
         for i in range(header.count()):
             self.imageTree.resizeColumnToContents(i)
+        QtCore.QTimer.singleShot(0, self._EnsureVisibleDecoded)
+
+    def _ScheduleEnsureVisible(self):
+        # coalesce the checks requested by a burst of finished thumbnails
+        if not self._ensurePending:
+            self._ensurePending = True
+            QtCore.QTimer.singleShot(0, self._EnsureVisibleDecoded)
+
+    def _EnsureVisibleDecoded(self):
+        # start a thumbnail worker for every visible row not yet decoded
+        self._ensurePending = False
+        viewport = self.imageTree.viewport().rect()
+        top = self.imageTree.indexAt(viewport.topLeft())
+        first = top.row() if top.isValid() else 0
+        pool = QtCore.QThreadPool.globalInstance()
+        for r in range(first, self.editModel.rowCount()):
+            rect = self.imageTree.visualRect(self.editModel.index(r, 1))
+            if rect.top() > viewport.bottom():
+                break
+            if r in self._decoded or not rect.intersects(viewport):
+                continue
+            self._decoded.add(r)
+            item = self.editModel.item(r, 0)
+            apath = item.data(QtCore.Qt.UserRole + 1)
+            mime = item.data(QtCore.Qt.UserRole + 2)
+            pool.start(ThumbnailRunnable(r, apath, mime, self.ThumbnailSize, self.thumbSignals))
+
+    def SetThumbnail(self, row, size, base, img):
+        if row >= self.editModel.rowCount():
+            return
+        self._thumbnailed.add(row)
+        # the size changed while this one was being rendered
+        if size != self.ThumbnailSize:
+            img = self._ScaleThumbnail(base)
+        self.editModel.item(row, 1).setData(QtGui.QPixmap.fromImage(img), QtCore.Qt.DecorationRole)
+        # a thumbnail shorter than the square placeholder shrinks its row
+        # and can pull rows that were never decoded into view
+        self._ScheduleEnsureVisible()
+
+    def _ScaleThumbnail(self, img, mode=QtCore.Qt.SmoothTransformation):
+        return img.scaled(
+            self.ThumbnailSize, self.ThumbnailSize,
+            QtCore.Qt.KeepAspectRatio, mode
+        )
 
     def DecreaseThumbnailSize(self):
         self.ThumbnailSize = max(0, self.ThumbnailSize - _THUMBNAIL_SIZE_INCREMENT)
-        self.UpdateThumbnails()
+        self._draft = True
+        self._resizeTimer.start()
 
     def IncreaseThumbnailSize(self):
         self.ThumbnailSize += _THUMBNAIL_SIZE_INCREMENT
-        self.UpdateThumbnails()
+        self._draft = True
+        self._resizeTimer.start()
 
     def UpdateThumbnails(self):
+        if self._draft:
+            mode = QtCore.Qt.FastTransformation
+        else:
+            mode = QtCore.Qt.SmoothTransformation
         for r in range(self.editModel.rowCount()):
             item = self.editModel.item(r, 0)
-            apath = item.data(QtCore.Qt.UserRole + 1)
-            mime = item.data(QtCore.Qt.UserRole + 2)
-            if mime == 'image/svg+xml':
-                img = RenderSvgToImage(apath)
-            else:
-                img = QtGui.QImage(apath)
-            pix = QtGui.QPixmap.fromImage(img).scaled(
-                self.ThumbnailSize, self.ThumbnailSize,
-                QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation
-            )
-            self.editModel.item(r, 1).setData(pix, QtCore.Qt.DecorationRole)
+            img = _BASE_IMAGES.get(item.data(QtCore.Qt.UserRole + 1), item.data(QtCore.Qt.UserRole + 2))
+            if img is None:
+                if r in self._thumbnailed:
+                    # evicted from the cache, decode again once back in view
+                    self._thumbnailed.discard(r)
+                    self._decoded.discard(r)
+                # otherwise not decoded yet, SetThumbnail will scale it when done
+                continue
+            thumb = self._ScaleThumbnail(img, mode)
+            self.editModel.item(r, 1).setData(QtGui.QPixmap.fromImage(thumb), QtCore.Qt.DecorationRole)
+        # smaller thumbnails may have brought more rows into view
+        self._ScheduleEnsureVisible()
+        if self._draft:
+            self._draftSize = self.ThumbnailSize
+            QtCore.QTimer.singleShot(_THUMBNAIL_SMOOTH_DELAY, self._SmoothPass)
+
+    def _SmoothPass(self):
+        # skip if the size changed again since the draft pass
+        if self._draftSize != self.ThumbnailSize or self._resizeTimer.isActive():
+            return
+        self._draft = False
+        self.UpdateThumbnails()
 
     def UpdateAltTextForItem(self, item):
-        idx = self.editModel.indexFromItem(item)
-        if idx.column() == _COL_ALTTEXT:
-            key = self.editModel.item(idx.row(), 0).data(QtCore.Qt.UserRole + 3)
-            self.altdata[key] = item.text()
+        # thumbnail updates also land here so bail out before any work
+        if item.column() != _COL_ALTTEXT:
+            return
+        key = self._rowkeys[item.row()]
+        self.altdata[key] = item.text()
 
     def onAIFillAll(self):
-        api_key = os.getenv('OPENAI_API_KEY')
+        # stray whitespace would make http.client reject the auth header
+        api_key = (os.getenv('OPENAI_API_KEY') or '').strip()
         if not api_key:
             QtWidgets.QMessageBox.critical(
                 self, 'API Key Mancante', 'Imposta OPENAI_API_KEY per usare l IA.'
@@ -214,19 +595,40 @@ class AltTextEditor(QtWidgets.QDialog):
             'Autofill ALT con IA...', None, 0, len(missing), self
         )
         dlg.setWindowModality(QtCore.Qt.WindowModal)
-        count = 0
+        work = []
         for r in missing:
-            apath = self.editModel.item(r, 0).data(QtCore.Qt.UserRole + 1)
-            print(f"[Access-Aide] Requesting ALT for: {apath}")
-            alt = self._generate_alt(apath, api_key)
-            print(f"[Access-Aide] Received ALT: {alt}")
-            if alt:
-                self.editModel.item(r, 2).setText(alt)
-                key = self.editModel.item(r, 0).data(QtCore.Qt.UserRole + 3)
-                self.altdata[key] = alt
-                count += 1
-            dlg.setValue(count)
-            QtWidgets.QApplication.processEvents()
+            item = self.editModel.item(r, 0)
+            work.append((r, item.data(QtCore.Qt.UserRole + 1), item.data(QtCore.Qt.UserRole + 2)))
+        chunks = [work[i:i + _AI_BATCH_SIZE] for i in range(0, len(work), _AI_BATCH_SIZE)]
+        count = 0
+        done = 0
+        # requests are network bound so run them concurrently and only
+        # touch the model from this (the gui) thread as each one finishes
+        with ThreadPoolExecutor(max_workers=_AI_MAX_WORKERS) as ex:
+            futures = {}
+            for chunk in chunks:
+                images = [(apath, mime) for (r, apath, mime) in chunk]
+                _log.info("Requesting ALT for: %s", [apath for (apath, mime) in images])
+                futures[ex.submit(self._generate_alts_batch, images, api_key)] = chunk
+            for fut in as_completed(futures):
+                chunk = futures[fut]
+                try:
+                    alts = fut.result()
+                except Exception as e:
+                    # one failed batch must not abort the whole autofill
+                    _log.warning("ALT request failed for %s: %s",
+                                 [apath for (r, apath, mime) in chunk], e)
+                    alts = [''] * len(chunk)
+                for (r, apath, mime), alt in zip(chunk, alts):
+                    _log.info("Received ALT for %s: %s", apath, alt)
+                    if alt:
+                        self.editModel.item(r, 2).setText(alt)
+                        key = self._rowkeys[r]
+                        self.altdata[key] = alt
+                        count += 1
+                done += len(chunk)
+                dlg.setValue(done)
+                QtWidgets.QApplication.processEvents()
         dlg.close()
         self.btnAIfill.setText('Autofill with IA')
         self.btnAIfill.setEnabled(True)
@@ -235,58 +637,112 @@ class AltTextEditor(QtWidgets.QDialog):
             self, 'Autofill IA', f'Aggiornati {count} ALT su {len(missing)}'
         )
 
-    def _generate_alt(self, src, api_key):
+    def _image_data_url(self, src, mime):
+        b64 = _encode_image_for_api(src, mime)
+        if b64 is not None:
+            return b'data:image/jpeg;base64,' + b64
+        # Qt could not decode it so send the file as is with its real type
         try:
             with open(src, 'rb') as f:
-                b64 = base64.b64encode(f.read()).decode()
+                # encode straight from the mapped file without a bytes copy
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    b64 = base64.b64encode(mm)
+            return b'data:' + mime.encode('ascii') + b';base64,' + b64
         except Exception as e:
-            print(f"[Access-Aide] Failed to read image {src}: {e}")
-            return ''
-        payload = {
-            'model': 'gpt-4o-mini',
-            'input': [
-                {
-                    'role': 'user',
-                    'content': [
-                         {
-                        "type": "input_image",
-                        "image_url": f"data:image/jpeg;base64,{b64}"
-                        },
-                        {
-                        "type": "input_text",
-                        "text": "descrivi l'immagine per compilare l'attributo ALT html"
-                        }
-                    ]
-                }
-            ]
-        }
+            _log.warning("Failed to read image %s: %s", src, e)
+            return None
+
+    def _request_output_text(self, body, api_key):
+        # returns (text, error) where error is the placeholder to use as ALT
         headers = {
             'Authorization': f'Bearer {api_key}',
             'Content-Type': 'application/json'
         }
-        print(f"[Access-Aide] Payload: {json.dumps(payload)[:200]}...")
-        print(f"[Access-Aide] Headers: {headers}")
-        req = urllib.request.Request(
-            'https://api.openai.com/v1/responses',
-            data=json.dumps(payload).encode(),
-            headers=headers,
-            method='POST'
-        )
-        try:
-            with urllib.request.urlopen(req, timeout=30) as resp:
-                status = resp.getcode()
-                print(f"[Access-Aide] Response status: {status}")
-                resp_data = resp.read().decode()
-                print(f"[Access-Aide] Response body: {resp_data[:1000]}...")
-                data = json.loads(resp_data)
-                desc = data['output'][0]['content'][0]['text'].strip()
-                return desc if len(desc) <= 400 else desc[:397] + '...'
-        except urllib.error.HTTPError as e:
-            print(f"[Access-Aide] HTTPError {e.code}: {e.reason}")
-            return f"ERROR_API_{e.code}"
-        except Exception as e:
-            print(f"[Access-Aide] Unexpected error: {e}")
-            return ''
+        _log.debug("Payload: %s...", body[:200])
+        # retry with exponential backoff on rate limiting and server errors
+        for attempt in range(_AI_MAX_ATTEMPTS):
+            fresh = False
+            while True:
+                conn, reused = _AI_POOL.acquire(fresh)
+                error = None
+                try:
+                    conn.request('POST', _AI_API_PATH, body=body, headers=headers)
+                    resp = conn.getresponse()
+                    status = resp.status
+                    _log.debug("Response status: %s", status)
+                    # always drain the body so the connection can be reused
+                    resp_data = resp.read()
+                except (http.client.HTTPException, OSError) as e:
+                    _AI_POOL.discard(conn)
+                    # timeouts are not resent here as the request may well
+                    # have reached the server, only a dropped keep alive is
+                    if reused and isinstance(e, _STALE_CONN_ERRORS):
+                        # a kept-alive connection the server already closed,
+                        # so try again at once on a new one without a backoff
+                        fresh = True
+                        continue
+                    error = e
+                break
+            if error is not None:
+                _log.warning("Connection error: %s", error)
+                if attempt + 1 < _AI_MAX_ATTEMPTS:
+                    time.sleep(2 ** attempt)
+                    continue
+                return None, ''
+            if resp.will_close:
+                _AI_POOL.discard(conn)
+            else:
+                _AI_POOL.release(conn)
+            if not 200 <= status < 300:
+                _log.warning("HTTPError %s: %s", status, resp.reason)
+                if status in _AI_RETRY_STATUS and attempt + 1 < _AI_MAX_ATTEMPTS:
+                    time.sleep(2 ** attempt)
+                    continue
+                return None, f"ERROR_API_{status}"
+            _log.debug("Response body: %s...", resp_data[:1000])
+            try:
+                data = _loads(resp_data)
+                return data['output'][0]['content'][0]['text'].strip(), ''
+            except Exception as e:
+                _log.warning("Unexpected error: %s", e)
+                return None, ''
+
+    def _generate_alts_batch(self, images, api_key):
+        # send every (path, mime) image of the batch in one request and ask
+        # for a JSON array of ALT texts back in the same order as the images
+        alts = [''] * len(images)
+        urls = []
+        idxs = []
+        for i, (src, mime) in enumerate(images):
+            url = self._image_data_url(src, mime)
+            if url is None:
+                continue
+            idxs.append(i)
+            urls.append(url)
+        if not idxs:
+            return alts
+        prompt_part = _AI_PROMPT_PART if len(idxs) == 1 else _AI_BATCH_PROMPT_PART
+        body = _build_payload(urls, prompt_part)
+        text, err = self._request_output_text(body, api_key)
+        if text is None:
+            for i in idxs:
+                alts[i] = err
+            return alts
+        if len(idxs) == 1:
+            alts[idxs[0]] = _clip_alt(text)
+            return alts
+        descs = _parse_alt_list(text, len(idxs))
+        if descs is None:
+            # the reply can not be safely matched to the images, so ask
+            # for each one on its own rather than risk a wrong ALT
+            _log.warning("Unusable batch reply, retrying %d images one at a time", len(idxs))
+            for i, url in zip(idxs, urls):
+                text, err = self._request_output_text(_build_payload([url], _AI_PROMPT_PART), api_key)
+                alts[i] = err if text is None else _clip_alt(text)
+            return alts
+        for i, desc in zip(idxs, descs):
+            alts[i] = _clip_alt(desc)
+        return alts
 
     def AcceptChanges(self):
         self.said_ok = True
@@ -300,4 +756,5 @@ def GUIUpdateFromList(resources, basewidth):
     app = QtWidgets.QApplication(sys.argv)
     dlg = AltTextEditor(resources, basewidth)
     dlg.exec()
+    QtCore.QThreadPool.globalInstance().waitForDone()
     return dlg.GetResults()
@@ -12,16 +12,32 @@ import sys
 import os
 import tempfile, shutil
 import re
+import io
+import struct
+import zlib
 import inspect
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
-from accessgui import GUIUpdateFromList
 from urllib.parse import unquote
 from urllib.parse import urlparse
-from PIL import Image
-from sigil_bs4 import BeautifulSoup
+from lxml import etree
 
-# define unit separator
-_US = chr(31)
+# whitespace quickparser may leave around attribute names
+_ATTR_WS = ' \v\t\n\r\f'
+
+_XML_NS = "http://www.w3.org/XML/1998/namespace"
+
+# lenient parser for small xmp/svg blobs, never fetch dtds or expand entities
+_xml_parser = etree.XMLParser(recover=True, resolve_entities=False, no_network=True)
+
+# strict parser for the nav and ncx, anything not well formed uses quickparser
+_xml_strict_parser = etree.XMLParser(resolve_entities=False, no_network=True)
+
+_EPUB_TYPE = "{http://www.idpf.org/2007/ops}type"
+
+# any existing schema:access* meta (epub3 property or epub2 name) in the opf metadata
+_HAS_ACCESS_RE = re.compile(r'''(?:property|name)\s*=\s*["']schema:access''')
 
 _SCRIPT_DIR = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 
@@ -176,30 +192,36 @@ _all_role_tags = {
     "wbr"        : (True, False)
 }
 
+# several entries above are single strings "(tag)" rather than tuples so
+# normalize every value to a frozenset to get exact tag name membership
+_aria_role_allowed_tags = {
+    role: frozenset((tags,) if isinstance(tags, str) else tags)
+    for role, tags in _aria_role_allowed_tags.items()
+}
+
+# fold the (href_allowed, need_alt) conditions into one bit mask per tag
+_HREF_OK = 1
+_NEED_ALT = 2
+_all_role_tags = {
+    tname: (_HREF_OK if href_allowed else 0) | (_NEED_ALT if need_alt else 0)
+    for tname, (href_allowed, need_alt) in _all_role_tags.items()
+}
+
 # epub 3.2 and aria rules makes this quite a mess
 def _role_from_etype(etype, tname, has_href, has_alt):
     # first get role for epub type from map
     role = _epubtype_aria_map.get(etype, None)
     if role is None:
         return role
-    # a possible role exists, check if allowed
-    allowed = False
     # check if role would be in a tag that allows all roles
     # subject to conditions
-    if tname in _all_role_tags:
-        allowed = True
-        (href_allowed, need_alt) = _all_role_tags[tname]
-        if not href_allowed and has_href:
-            allowed = False
-        if need_alt and not has_alt:
-            allowed = False
-    if allowed:
-        return role
-    # still need to check for specifc additions/exceptions
-    if role in _aria_role_allowed_tags:
-        tagset = _aria_role_allowed_tags[role]
-        if tname in tagset:
+    flags = _all_role_tags.get(tname)
+    if flags is not None:
+        if (flags & _HREF_OK or not has_href) and (has_alt or not flags & _NEED_ALT):
             return role
+    # still need to check for specifc additions/exceptions
+    if tname in _aria_role_allowed_tags.get(role, ()):
+        return role
     return None
 
 _USER_HOME = os.path.expanduser("~")
@@ -213,42 +235,137 @@ def baselang(lang):
             return lang[0:2]
     return None
 
-def parse_xmpxml_for_alttext(xmpxml):
-    xmpmeta = BeautifulSoup(xmpxml, 'xml')
-    alt_dict = {}
-    if xmpmeta:
-        node = xmpmeta.find('AltTextAccessibility')
-        if node:
-            for element in node.find_all('li'):
-                lang = element.get('xml:lang', 'x-default')
-                alt_dict[lang] = element.text
-                lg = baselang(lang)
-                if lg:
-                    alt_dict[lg] = element.txt
-    return alt_dict
+# parse xml text or bytes into an lxml root element (None if unparseable)
+def parse_xml_root(xmldata):
+    if isinstance(xmldata, str):
+        xmldata = xmldata.encode('utf-8')
+    try:
+        return etree.fromstring(xmldata, _xml_parser)
+    except (etree.XMLSyntaxError, ValueError):
+        return None
+
+# parse well formed xml text or bytes into an lxml root element (None if not)
+def parse_strict_xml_root(xmldata):
+    if isinstance(xmldata, str):
+        xmldata = xmldata.encode('utf-8')
+    try:
+        return etree.fromstring(xmldata, _xml_strict_parser)
+    except (etree.XMLSyntaxError, ValueError):
+        return None
+
+# find the AltTextAccessibility entry that best matches tgtlang
+# an exact language match ends the walk, otherwise the first entry sharing
+# the base language wins, then x-default (None if nothing matched)
+def parse_xmpxml_for_alttext(xmpxml, tgtlang):
+    xmpmeta = parse_xml_root(xmpxml)
+    if xmpmeta is None:
+        return None
+    node = next(xmpmeta.iter('{*}AltTextAccessibility'), None)
+    if node is None:
+        return None
+    lg = baselang(tgtlang)
+    base_match = None
+    default = None
+    for element in node.iter('{*}li'):
+        lang = element.get('{%s}lang' % _XML_NS, 'x-default')
+        if lang == tgtlang:
+            return "".join(element.itertext())
+        if base_match is None:
+            elg = baselang(lang)
+            if elg == tgtlang or (lg and (lang == lg or elg == lg)):
+                base_match = "".join(element.itertext())
+                continue
+        if default is None and lang == 'x-default':
+            default = "".join(element.itertext())
+    if base_match is not None:
+        return base_match
+    return default
 
 # extract top level desc text from svg
 def parse_svgxml_for_desc(svgxml):
-    svgsoup = BeautifulSoup(svgxml, 'xml')
+    svgroot = parse_xml_root(svgxml)
     desc = ""
-    if svgsoup:
-        node = svgsoup.find('desc')
-        if node:
-            desc = node.text
+    if svgroot is not None:
+        node = next(svgroot.iter('{*}desc'), None)
+        if node is not None:
+            desc = "".join(node.itertext())
     return desc
 
-# extract alt text from image metadata
-def get_image_metadata_alttext(imgpath, tgtlang):
+_PNG_SIG = b"\x89PNG\r\n\x1a\n"
+_PNG_XMP_KEY = b"XML:com.adobe.xmp"
+_PNG_RAW_EXIF_KEY = b"Raw profile type exif"
+
+# walk the png chunks for xmp without having Pillow decode anything
+# returns (xmpxml, needs_pillow) where needs_pillow is set if there is exif to parse
+def scan_png_metadata(imgdata):
+    xmpxml = None
+    pos = len(_PNG_SIG)
+    end = len(imgdata)
+    while pos + 8 <= end:
+        length, ctype = struct.unpack_from(">I4s", imgdata, pos)
+        start = pos + 8
+        if ctype == b"IEND":
+            break
+        if ctype == b"eXIf":
+            return xmpxml, True
+        if ctype in (b"tEXt", b"zTXt", b"iTXt"):
+            chunk = imgdata[start:start + length]
+            keyend = chunk.find(b"\x00")
+            key = chunk[:keyend]
+            if key == _PNG_RAW_EXIF_KEY:
+                return xmpxml, True
+            if key == _PNG_XMP_KEY and xmpxml is None:
+                # Pillow accepts the xmp keyword in any of the text chunks
+                # tEXt: keyword\0 text
+                # zTXt: keyword\0 compression method, zlib text
+                # iTXt: keyword\0 compression flag, compression method, language\0 translated keyword\0 text
+                text = None
+                compressed = False
+                if ctype == b"tEXt":
+                    text = chunk[keyend + 1:]
+                elif ctype == b"zTXt":
+                    text = chunk[keyend + 2:]
+                    compressed = True
+                else:
+                    compressed = chunk[keyend + 1:keyend + 2] == b"\x01"
+                    langend = chunk.find(b"\x00", keyend + 3)
+                    textstart = chunk.find(b"\x00", langend + 1) + 1
+                    if langend != -1 and textstart > 0:
+                        text = chunk[textstart:]
+                if text is not None:
+                    try:
+                        xmpxml = zlib.decompress(text) if compressed else text
+                    except zlib.error:
+                        pass
+        # skip the chunk data and its crc
+        pos = start + length + 4
+    return xmpxml, False
+
+# walk the webp riff chunks for xmp without having Pillow decode anything
+# returns (xmpxml, needs_pillow) where needs_pillow is set if there is exif to parse
+def scan_webp_metadata(imgdata):
+    xmpxml = None
+    pos = 12
+    end = len(imgdata)
+    while pos + 8 <= end:
+        ctype, length = struct.unpack_from("<4sI", imgdata, pos)
+        start = pos + 8
+        if ctype == b"EXIF":
+            return xmpxml, True
+        if ctype == b"XMP ":
+            xmpxml = imgdata[start:start + length]
+        # chunks are padded to an even size
+        pos = start + length + (length & 1)
+    return xmpxml, False
+
+# let Pillow pull the xmp and exif description from the image headers
+# returns (xmpxml, description)
+def get_pillow_metadata(imgdata):
+    # Pillow is slow to import and many books never need it
+    from PIL import Image
     xmpxml = None
     description = ""
-    # handle svg as special case since Pillow barfs on it
-    if imgpath.lower().endswith('.svg'):
-        svgxml=""
-        with open(imgpath, 'rb') as f:
-            svgxml = f.read().decode('utf-8')
-        description = parse_svgxml_for_desc(svgxml)
-        return description
-    with Image.open(imgpath) as im:
+    with Image.open(io.BytesIO(imgdata)) as im:
         if im.format == 'WebP':
             if "xmp" in im.info:
                xmpxml = im.info["xmp"]
@@ -269,58 +386,75 @@ def get_image_metadata_alttext(imgpath, tgtlang):
         # 270 = ImageDescription
         if exif and 270 in exif:
             description = exif[270]
+    return xmpxml, description
+
+# extract alt text from image metadata
+# works from the image bytes already in memory rather than re-reading a file
+def get_image_metadata_alttext(imgdata, mime, tgtlang):
+    xmpxml = None
+    description = ""
+    # handle svg as special case since Pillow barfs on it
+    if mime == "image/svg+xml":
+        description = parse_svgxml_for_desc(imgdata)
+        return description
+    # sniff the signature so Pillow is only used when really needed,
+    # png and webp xmp can be read straight from their chunks unless
+    # there is also exif, and gif has nothing we look for
+    needs_pillow = True
+    if imgdata.startswith(_PNG_SIG):
+        xmpxml, needs_pillow = scan_png_metadata(imgdata)
+    elif imgdata[:4] == b"RIFF" and imgdata[8:12] == b"WEBP":
+        xmpxml, needs_pillow = scan_webp_metadata(imgdata)
+    elif imgdata[:4] == b"GIF8":
+        needs_pillow = False
+    if needs_pillow:
+        xmpxml, description = get_pillow_metadata(imgdata)
     if not xmpxml:
         return description
-    alt_dict = parse_xmpxml_for_alttext(xmpxml)
-    # first try full language code match
-    if tgtlang in alt_dict:
-        return alt_dict[tgtlang]
-     # next try base language code match
-    lg = baselang(tgtlang)
-    if lg and lg in alt_dict:
-        return alt_dict[lg]
-    # use default
-    if 'x-default' in alt_dict:
-        return alt_dict['x-default']
+    alttext = parse_xmpxml_for_alttext(xmpxml, tgtlang)
+    if alttext is not None:
+        return alttext
     # otherwise fall back to exif image description
     return description
 
+_xml_encode_table = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;'})
+
+_xml_decode_re = re.compile(r'&(amp|lt|gt|quot);')
+_xml_decode_map = {'amp': '&', 'lt': '<', 'gt': '>', 'quot': '"'}
+
 # encode strings for xml
 def xmlencode(data):
     if data is None:
         return ''
-    newdata = data
-    newdata = newdata.replace('&', '&amp;')
-    newdata = newdata.replace('<', '&lt;')
-    newdata = newdata.replace('>', '&gt;')
-    newdata = newdata.replace('"', '&quot;')
-    return newdata
+    return data.translate(_xml_encode_table)
 
 # decode xml encoded strings
 def xmldecode(data):
     if data is None:
         return ''
-    newdata = data
-    newdata = newdata.replace('&quot;', '"')
-    newdata = newdata.replace('&gt;', '>')
-    newdata = newdata.replace('&lt;', '<')
-    newdata = newdata.replace('&amp;', '&')
-    return newdata
-
-whitespace_re = re.compile("\s+")
+    return _xml_decode_re.sub(lambda m: _xml_decode_map[m.group(1)], data)
 
 # handle possible space delimtied multiple attribute values
 def parse_attribute(avalue):
-    vals = []
+    # str.split() with no separator already collapses runs of whitespace
+    # and drops empty values, so no regex is needed
     if avalue is None:
-        return vals
-    val = avalue.strip()
-    if " " in val:
-        vals = whitespace_re.split(val)
-    else:
-        if val != "":
-            vals.append(val)
-    return vals
+        return []
+    return avalue.split()
+
+# resolve an href relative to start_dir into its (bookpath, fragment)
+# the same targets and images are referenced over and over so cache them
+# (run requires a launcher recent enough to always have build_bookpath)
+@lru_cache(maxsize=4096)
+def resolve_href(bk, href, start_dir):
+    urlobj = urlparse(href)
+    apath = unquote(urlobj.path)
+    return bk.build_bookpath(apath, start_dir), urlobj.fragment
+
+# write data to a file (used by the temp image copy workers)
+def write_file(filepath, data):
+    with open(filepath, "wb") as f:
+        f.write(data)
 
 # the plugin entry point
 def run(bk):
@@ -352,16 +486,21 @@ def run(bk):
     navbookpath = None
     if E3:
         for mid, href, mtype, mprops, fallback, moverlay in bk.manifest_epub3_iter():
-            if mprops is not None and "mathml" in mprops:
+            if not mprops:
+                continue
+            # match whole property values only
+            propset = set(mprops.split())
+            if "mathml" in propset or "scripted" in propset:
                 add_accessibility_metadata = False
-            if mprops is not None and "scripted" in mprops:
-                add_accessibility_metadata = False
-            if mprops is not None and "nav" in mprops:
+            if "nav" in propset:
                 navid = mid
                 urlobj = urlparse(href)
                 path = unquote(urlobj.path)
                 navfilename = os.path.basename(path)
                 navbookpath = bk.id_to_bookpath(navid)
+            # nothing left to learn from the rest of the manifest
+            if navid is not None and not add_accessibility_metadata:
+                break
         if navid is None:
             print("Error: nav property missing from the opf manifest propertiese")
             return -1
@@ -374,48 +513,52 @@ def run(bk):
     if add_accessibility_metadata:
         print("\nUpdating the OPF with accessibility schema")
     plang = None
-    res = []
-    has_access_meta = False
     qp = bk.qp
     metaxml = bk.getmetadataxml()
+    # one search of the raw metadata tells us if any schema:access meta already exists
+    has_access_meta = _HAS_ACCESS_RE.search(metaxml) is not None
     qp.setContent(metaxml)
-    for text, tagprefix, tagname, tagtype, tagattr in qp.parse_iter():
-        if text is not None:
-            res.append(text)
-            if tagprefix.endswith("dc:language"):
-                if plang is None:
-                    plang = text
-                    # if "-" in text:
-                    #     plang, region = text.split("-")
-        else:
-            if tagname == "meta" and tagtype == "begin":
-                if "property" in tagattr:
-                    prop = tagattr["property"]
-                    if prop.startswith("schema:access"):
-                        has_access_meta = True
-                if "name" in tagattr:
-                    name = tagattr["name"]
-                    if name.startswith("schema:access"):
-                        has_access_meta = True
-            if tagname == "metadata" and tagtype == "end":
-                # insert accessibility metadata if needed (assumes schema:accessModeSufficient="textual")
-                # which is why we abort if audio or video used, javascript, mathml
-                if E3 and not has_access_meta and add_accessibility_metadata:
-                    res.append('<meta property="schema:accessibilitySummary">This publication conforms to WCAG 2.1 AA.</meta>\n')
-                    res.append('<meta property="schema:accessMode">textual</meta>\n')
-                    res.append('<meta property="schema:accessMode">visual</meta>\n')
-                    res.append('<meta property="schema:accessModeSufficient">textual</meta>\n')
-                    res.append('<meta property="schema:accessibilityFeature">structuralNavigation</meta>\n')
-                    res.append('<meta property="schema:accessibilityHazard">none</meta>\n')
-                if not E3 and not has_access_meta and add_accessibility_metadata:
-                    res.append('<meta name="schema:accessibilitySummary" content="This publication conforms to WCAG 2.1 AA."/>\n')
-                    res.append('<meta name="schema:accessMode" content="textual"/>\n')
-                    res.append('<meta name="schema:accessModeSufficient" content="textual"/>\n')
-                    res.append('<meta name="schema:accessibilityFeature" content="structuralNavigation"/>\n')
-                    res.append('<meta name="schema:accessibilityHazard" content="none"/>\n')
-            res.append(qp.tag_info_to_xml(tagname, tagtype, tagattr))
-    metaxml = "".join(res)
-    bk.setmetadataxml(metaxml)
+    if has_access_meta or not add_accessibility_metadata:
+        # nothing to insert so only scan for the primary language
+        for text, tagprefix, tagname, tagtype, tagattr in qp.parse_iter():
+            if text is not None and tagprefix.rpartition(".")[2] == "dc:language":
+                # only the first dc:language matters so stop right there
+                plang = text
+                break
+    else:
+        res = []
+        dirty_meta = False
+        for text, tagprefix, tagname, tagtype, tagattr in qp.parse_iter():
+            if text is not None:
+                res.append(text)
+                if tagprefix.rpartition(".")[2] == "dc:language":
+                    if plang is None:
+                        plang = text
+                        # if "-" in text:
+                        #     plang, region = text.split("-")
+            else:
+                if tagname == "metadata" and tagtype == "end":
+                    # insert accessibility metadata (assumes schema:accessModeSufficient="textual")
+                    # which is why we abort if audio or video used, javascript, mathml
+                    dirty_meta = True
+                    if E3:
+                        res.append('<meta property="schema:accessibilitySummary">This publication conforms to WCAG 2.1 AA.</meta>\n')
+                        res.append('<meta property="schema:accessMode">textual</meta>\n')
+                        res.append('<meta property="schema:accessMode">visual</meta>\n')
+                        res.append('<meta property="schema:accessModeSufficient">textual</meta>\n')
+                        res.append('<meta property="schema:accessibilityFeature">structuralNavigation</meta>\n')
+                        res.append('<meta property="schema:accessibilityHazard">none</meta>\n')
+                    else:
+                        res.append('<meta name="schema:accessibilitySummary" content="This publication conforms to WCAG 2.1 AA."/>\n')
+                        res.append('<meta name="schema:accessMode" content="textual"/>\n')
+                        res.append('<meta name="schema:accessModeSufficient" content="textual"/>\n')
+                        res.append('<meta name="schema:accessibilityFeature" content="structuralNavigation"/>\n')
+                        res.append('<meta name="schema:accessibilityHazard" content="none"/>\n')
+                res.append(qp.tag_info_to_xml(tagname, tagtype, tagattr))
+        # only hand the metadata back if the accessibility schema was really inserted
+        if dirty_meta:
+            metaxml = "".join(res)
+            bk.setmetadataxml(metaxml)
 
     if plang is None:
         print("Error: at least one dc:language must be specified in the opf")
@@ -427,6 +570,7 @@ def run(bk):
         qp = bk.qp
         qp.setContent(pkg_tag)
         res = []
+        dirty_pkg = False
         for text, tagprefix, tagname, tagtype, tagattr in qp.parse_iter():
             if text is not None:
                 res.append(text)
@@ -434,9 +578,12 @@ def run(bk):
                 if tagname == "package" and tagtype == "begin":
                     if "xml:lang" not in tagattr:
                         tagattr["xml:lang"] = plang
+                        dirty_pkg = True
                 res.append(qp.tag_info_to_xml(tagname, tagtype, tagattr))
-        pkg_tag = "".join(res)
-        bk.setpackagetag(pkg_tag)
+        # leave an already conformant package tag alone
+        if dirty_pkg:
+            pkg_tag = "".join(res)
+            bk.setpackagetag(pkg_tag)
 
     # epub3 - collect titlemap and etypemap from the nav (key is file bookpath)
     # epub2 - collect titlemap from the ncx (key is file bookpath)
@@ -456,6 +603,9 @@ def run(bk):
     # and for E3 adding known nav landmark semantics epub:types 
     print("\nProcessing all xhtml files to add accessibility features")
     imglst = []
+    # keep the converted xhtml of files with images so alt text updates
+    # do not have to read them back from Sigil
+    xhtml_cache = {}
     for mid, href in bk.text_iter():
         bookpath = bk.id_to_bookpath(mid)
     
@@ -464,6 +614,7 @@ def run(bk):
         bk.writefile(mid, xhtmldata)
         if len(ilst) > 0:
             imglst.extend(ilst)
+            xhtml_cache[mid] = xhtmldata
 
     # allow user to update alt info for each image tag
     print("\nBuilding a GUI to speed image alt attribute updates")
@@ -471,38 +622,62 @@ def run(bk):
     # first prevent unsafe access of any files within Sigil 
     # by creating a temporary copy of each image in temp_dir
     # and build up database of bookpath to mimetype
+    # keep the bytes of images whose alt text may come from their metadata
     imgmime = {}
+    imgpaths = {}
+    imgbytes = {}
+    need_metadata = set(imgbookpath for (mid, bookpath, imgcnt, imgsrc, imgbookpath, alttext) in imglst if not alttext)
     temp_dir = tempfile.mkdtemp()
+    made_dirs = set()
+    # bk is not thread safe so images are read here one at a time
+    # but the writes to the temp folder are handed off to a pool
+    writer = ThreadPoolExecutor(max_workers=8)
+    writes = []
     for mid, href, mime in bk.image_iter():
         imgdata = bk.readfile(mid)
         bookpath = bk.id_to_bookpath(mid)
         if mime == "image/svg+xml":
             imgdata = imgdata.encode('utf-8')
-        filepath = os.path.join(temp_dir, bookpath.replace("/",os.sep))
+        # bookpaths always use "/" so join the segments for any OS
+        filepath = os.path.join(temp_dir, *bookpath.split("/"))
         imgmime[bookpath] = mime
+        imgpaths[bookpath] = filepath
+        if bookpath in need_metadata:
+            imgbytes[bookpath] = imgdata
+        # most images share a folder so only create each one once
         destdir = os.path.dirname(filepath)
-        if not os.path.exists(destdir):
-            os.makedirs(destdir)
-        with open(filepath, "wb") as f:
-            f.write(imgdata)
+        if destdir not in made_dirs:
+            os.makedirs(destdir, exist_ok=True)
+            made_dirs.add(destdir)
+        writes.append(writer.submit(write_file, filepath, imgdata))
+    writer.shutdown(wait=True)
+    # surface any write error just as the serial loop did
+    for w in writes:
+        w.result()
 
 
     # now build a list of images and current alt text to pass to the gui
     altlist = []
+    # the file and alt text each key had in the xhtml, to find what the user changed
+    imgrows = {}
     for (mid, bookpath, imgcnt, imgsrc, imgbookpath, alttext) in imglst:
         print("   ... ", bookpath, " #", imgcnt, " src:", imgsrc, " alt text:", alttext)
-        imgpath = os.path.join(temp_dir, imgbookpath.replace("/",os.sep))
+        key = (imgbookpath, bookpath, imgcnt)
+        imgrows[key] = (mid, imgsrc, alttext)
+        imgpath = imgpaths[imgbookpath]
+        mime = imgmime[imgbookpath]
         if not alttext or alttext=='':
-            alttext = get_image_metadata_alttext(imgpath, plang)
+            alttext = get_image_metadata_alttext(imgbytes[imgbookpath], mime, plang)
         alttxt = xmldecode(alttext)
-        mime = imgmime[imgbookpath]
-        key = imgbookpath + _US + bookpath + _US + str(imgcnt)
         altlist.append([imgpath, imgbookpath, mime, key, alttxt])
+    imgbytes.clear()
 
     # Allow the User to Change Any alt text strings they desire
     basewidth = prefs['basewidth']
     naltdict = None
     if len(altlist) > 0:
+       # only pull in Qt and the gui when there are images to show
+       from accessgui import GUIUpdateFromList
        naltdict = GUIUpdateFromList(altlist, basewidth)
 
     # done with temp folder so clean up after yourself
@@ -511,14 +686,17 @@ def run(bk):
     if naltdict:
         # process results of alt text gui updates and update the actual xhtml
         print("\n\nUpdating any changed alt attributes for img tags")
-        for mid, bookpath, imgcnt, imgsrc, imgbookpath, alttext in imglst:
-            key = imgbookpath + _US + bookpath + _US + str(imgcnt)
-            altnew = naltdict[key]
-            if alttext != altnew:
-                print("    ... alt text needs to be updated in: ", bookpath, imgsrc, altnew)
-                data = bk.readfile(mid)
-                data = update_alt_text(bk, data, imgcnt, imgsrc, altnew)
-                bk.writefile(mid, data)
+        # group the changes by file so each file is parsed and written once
+        altupdates = {}
+        # only visit the images whose alt text really changed
+        changed = {key: altnew for key, altnew in naltdict.items() if altnew != imgrows[key][2]}
+        for (imgbookpath, bookpath, imgcnt), altnew in changed.items():
+            mid, imgsrc, alttext = imgrows[(imgbookpath, bookpath, imgcnt)]
+            print("    ... alt text needs to be updated in: ", bookpath, imgsrc, altnew)
+            altupdates.setdefault(mid, {})[imgcnt] = altnew
+        for mid, imgalts in altupdates.items():
+            data = update_alt_text(bk, xhtml_cache[mid], imgalts)
+            bk.writefile(mid, data)
     
     print("Updating Complete")
     bk.savePrefs(prefs)
@@ -539,12 +717,62 @@ def parse_nav(bk, navid, navbookpath):
     nav_base = "OEBPS/Text"
     if bk.launcher_version() >= 20190927:
         nav_base = bk.get_startingdir(navbookpath)
+    navdata = bk.readfile(navid)
+    navroot = parse_strict_xml_root(navdata)
+    if navroot is None:
+        return parse_nav_qp(bk, navdata, navbookpath, nav_base)
+    titlemap = {}
+    etypemap = {}
+    # first text directly inside the first h1 is the title of the nav itself
+    for h1 in navroot.iter('{*}h1'):
+        texts = [h1.text] + [child.tail for child in h1]
+        navtitle = next((t for t in texts if t is not None), None)
+        if navtitle is not None:
+            titlemap[navbookpath] = xmlencode(navtitle)
+            break
+    prevbookpath = ""
+    done_toc = False
+    done_lms = False
+    for nav in navroot.iter('{*}nav'):
+        # nothing after the toc and landmarks navs is of any use
+        if done_toc and done_lms:
+            break
+        navtype = nav.get(_EPUB_TYPE)
+        if navtype == "toc":
+            done_toc = True
+            for a in nav.iter('{*}a'):
+                tochref = a.get("href")
+                label = next(a.itertext(), None)
+                if tochref is None or label is None:
+                    continue
+                bookpath = resolve_href(bk, tochref, nav_base)[0]
+                # titles are injected as is into the xhtml so keep them encoded
+                if bookpath != prevbookpath:
+                    titlemap[bookpath] = xmlencode(label)
+                prevbookpath = bookpath
+        elif navtype == "landmarks":
+            done_lms = True
+            for a in nav.iter('{*}a'):
+                lmhref = a.get("href")
+                etype = a.get(_EPUB_TYPE)
+                if lmhref is None or etype is None:
+                    continue
+                bookpath, fragment = resolve_href(bk, lmhref, nav_base)
+                if fragment != '':
+                    etypemap[bookpath] = ("id", fragment, etype)
+    return titlemap, etypemap
+
+
+# quickparser fallback of parse_nav for navs that are not well formed xml
+def parse_nav_qp(bk, navdata, navbookpath, nav_base):
     titlemap = {}
     etypemap = {}
     qp = bk.qp
-    qp.setContent(bk.readfile(navid))
+    qp.setContent(navdata)
     in_toc = False
     in_lms = False
+    done_toc = False
+    done_lms = False
     getlabel = False
     navtitle = None
     tochref = None
@@ -555,6 +783,12 @@ def parse_nav(bk, navid, navbookpath):
                 if tagattr is not None and "epub:type" in tagattr:
                     in_toc = tagattr["epub:type"] == "toc"
                     in_lms = tagattr["epub:type"] == "landmarks"
+            if tagname == "nav" and tagtype == "end":
+                done_toc = done_toc or in_toc
+                done_lms = done_lms or in_lms
+                # the rest of the nav has nothing more to give
+                if done_toc and done_lms and navtitle is not None:
+                    break
             if in_toc and tagname == "a" and tagtype == "begin":
                 if tagattr is not None and "href" in tagattr:
                     tochref = tagattr["href"]
@@ -564,13 +798,7 @@ def parse_nav(bk, navid, navbookpath):
                     lmhref = tagattr["href"]
                     if "epub:type" in tagattr:
                         etype = tagattr["epub:type"]
-                        urlobj = urlparse(lmhref)
-                        apath = unquote(urlobj.path)
-                        filename = os.path.basename(apath)
-                        bookpath = "OEBPS/Text/" + filename
-                        if bk.launcher_version() >= 20190927:
-                           bookpath = bk.build_bookpath(apath, nav_base)
-                        fragment = urlobj.fragment
+                        bookpath, fragment = resolve_href(bk, lmhref, nav_base)
                         if fragment != '':
                             etypemap[bookpath] = ("id", fragment, etype)
                         # else:
@@ -578,17 +806,12 @@ def parse_nav(bk, navid, navbookpath):
                             # are now "strongly discouraged"
                             # etypemap[bookpath] = ("body", '', etype)
         else:
-            if navtitle is None and tagprefix.endswith("h1"):
+            if navtitle is None and tagprefix.rpartition(".")[2] == "h1":
                 navtitle = text
                 titlemap[navbookpath] = navtitle
             if in_toc and getlabel:
                 if tochref is not None:
-                    urlobj = urlparse(tochref)
-                    apath = unquote(urlobj.path)
-                    filename = os.path.basename(apath)
-                    bookpath = "OEBPS/Text/" + filename;
-                    if bk.launcher_version() >= 20190927:
-                        bookpath = bk.build_bookpath(apath, nav_base)
+                    bookpath = resolve_href(bk, tochref, nav_base)[0]
                     if bookpath != prevbookpath:
                         titlemap[bookpath] = text
                     prevbookpath = bookpath
@@ -604,6 +827,34 @@ def parse_ncx(bk, tocid, ncxbookpath):
     if bk.launcher_version() >= 20190927:
         ncx_base = bk.get_startingdir(ncxbookpath)
     ncxdata = bk.readfile(tocid)
+    ncxroot = parse_strict_xml_root(ncxdata)
+    if ncxroot is None:
+        return parse_ncx_qp(bk, ncxdata, ncx_base)
+    titlemap = {}
+    prevbookpath = ""
+    # only walk the navMap, any pageList or navList that follows has no navPoints
+    navmap = ncxroot.find('{*}navMap')
+    if navmap is None:
+        return titlemap
+    for navpoint in navmap.iter('{*}navPoint'):
+        content = navpoint.find('{*}content')
+        if content is None or content.get("src") is None:
+            continue
+        label = navpoint.find('{*}navLabel/{*}text')
+        navlabel = None
+        if label is not None:
+            # titles are injected as is into the xhtml so keep them encoded
+            navlabel = xmlencode("".join(label.itertext()).strip())
+        href = content.get("src")
+        bookpath = resolve_href(bk, href, ncx_base)[0]
+        if bookpath != prevbookpath:
+            titlemap[bookpath] = navlabel
+        prevbookpath = bookpath
+    return titlemap
+
+
+# quickparser fallback of parse_ncx for ncxs that are not well formed xml
+def parse_ncx_qp(bk, ncxdata, ncx_base):
     bk.qp.setContent(ncxdata)
     titlemap = {}
     navlable = None
@@ -615,14 +866,12 @@ def parse_ncx(bk, tocid, ncxbookpath):
             if tp.endswith('.navpoint.navlabel.text'):
                 navlabel = txt.strip()
         else:            
-            if tname == "content" and tattr is not None and "src" in tattr and tp.endswith("navpoint"):
+            # titles only come from the navMap so stop once it closes
+            if tname == "navmap" and ttype == "end":
+                break
+            if tname == "content" and tattr is not None and "src" in tattr and tp.rpartition(".")[2] == "navpoint":
                 href =  tattr["src"]
-                urlobj = urlparse(href)
-                apath = unquote(urlobj.path)
-                filename = os.path.basename(apath)
-                bookpath = "OEBPS/Text/" + filename
-                if bk.launcher_version() >= 20190927:
-                    bookpath = bk.build_bookpath(apath, ncx_base)
+                bookpath = resolve_href(bk, href, ncx_base)[0]
                 if bookpath != prevbookpath:
                     titlemap[bookpath] = navlabel
                 prevbookpath = bookpath
@@ -651,25 +900,33 @@ def convert_xhtml(bk, mid, bookpath, plang, titlemap, etypemap, E3):
     imgcnt = 0
     imglst = []
     start_dir = bk.get_startingdir(bookpath)
+    # hoist loop invariant lookups out of the per token loop
+    append = res.append
+    tag_info_to_xml = qp.tag_info_to_xml
+    fix_xmlheader = bk.launcher_version() < 20210203
     
     for text, tprefix, tname, ttype, tattr in qp.parse_iter():
         # bug in quickparser does not properly trim attribute names
-        if tattr:
-            nattr = {}
-            for attname, attval in tattr.items():
-                attname = attname.strip(' \v\t\n\r\f')
-                nattr[attname] = attval
-            tattr.clear()
-            tattr = nattr
+        # only rebuild the attributes for the rare tags that need it
+        if text is None and tattr:
+            if any(attname != attname.strip(_ATTR_WS) for attname in tattr):
+                nattr = {}
+                for attname, attval in tattr.items():
+                    attname = attname.strip(_ATTR_WS)
+                    nattr[attname] = attval
+                tattr.clear()
+                tattr = nattr
         if text is not None:
             # get any existing title in head, ignore whitespace
-            if "head" in tprefix and tprefix.endswith("title"):
+            # compare the innermost tag first, the containment test rarely runs
+            if tprefix.rpartition(".")[2] == "title" and "head" in tprefix:
                 if text.strip() != "":
                     maintitle = text
-            res.append(text)
+            append(text)
         else:
+            opening = ttype in ("single", "begin")
             # add missing epub:type for nav landmarks that point to fragments
-            if E3 and loctype == "id" and ttype in ("single", "begin"):
+            if E3 and loctype == "id" and opening:
                 if "id" in tattr:
                     id = tattr["id"]
                     if id == fragment:
@@ -696,21 +953,19 @@ def convert_xhtml(bk, mid, bookpath, plang, titlemap, etypemap, E3):
 
             # add missing alt text attributes on img tags
             # build up list of img links and current alt text
-            if tname == "img" and ttype in ("single", "begin"):
+            if tname == "img" and opening:
                 imgcnt += 1
                 alttext = tattr.get("alt", "")
                 tattr["alt"] = alttext
                 imgsrc = tattr.get("src","")
-                urlobj = urlparse(imgsrc)
-                apath = unquote(urlobj.path)
-                imgbookpath = bk.build_bookpath(apath, start_dir)
+                imgbookpath = resolve_href(bk, imgsrc, start_dir)[0]
                 imglst.append((mid, bookpath, imgcnt, imgsrc, imgbookpath, alttext)) 
 
             # build add any aria roles you know based on epub:type attributes
             # handle multiple epub:type attribute values
             # handle multiple aria role attribute values
             if E3:
-                if ttype in ["begin", "single"] and "epub:type" in tattr:
+                if opening and "epub:type" in tattr:
                     evals = parse_attribute(tattr["epub:type"])
                     rvals = parse_attribute(tattr.get("role",""))
                     has_href = "href" in tattr
@@ -728,30 +983,31 @@ def convert_xhtml(bk, mid, bookpath, plang, titlemap, etypemap, E3):
             # inject any missing titles if possible
             if tname == "title" and ttype == "end" and "head" in tprefix:
                 if maintitle is None:
-                    res.append(titlemap.get(bookpath,""))
+                    append(titlemap.get(bookpath,""))
 
             # inject any missing titles in self closed title tags  if needed
             if tname == "title" and ttype == "single" and "head" in tprefix:
                 ttype = "begin"
-                res.append(qp.tag_info_to_xml(tname, ttype, tattr))
-                res.append(titlemap.get(bookpath,""))
+                append(tag_info_to_xml(tname, ttype, tattr))
+                append(titlemap.get(bookpath,""))
                 tattr = {}
                 ttype = "end"
 
             # work around quickparser serialization bug in Sigil 1.4.3 and earlier
-            if bk.launcher_version() < 20210203:
+            if fix_xmlheader:
                 if ttype == "xmlheader":
                     if tattr and "special" in tattr:
                         tattr["special"] = tattr["special"].strip()
                         
-            res.append(qp.tag_info_to_xml(tname, ttype, tattr))
+            append(tag_info_to_xml(tname, ttype, tattr))
 
     return "".join(res), imglst
 
 
 # update xhtml img tag alt attribute text
+# imgalts maps image count (1 based) within the file to its new alt text
 # returns updated xhtml
-def update_alt_text(bk, xhtmldata, imgcnt, imgsrc, alttext):
+def update_alt_text(bk, xhtmldata, imgalts):
     res = []
     imgptr = 0
     # parse the xhtml, converting on the fly to update it
@@ -765,8 +1021,8 @@ def update_alt_text(bk, xhtmldata, imgcnt, imgsrc, alttext):
             # build up list of img links and current alt text
             if tname == "img" and ttype in ("single", "begin"):
                 imgptr += 1
-                if imgptr == imgcnt:
-                    tattr["alt"] = xmlencode(alttext)
+                if imgptr in imgalts:
+                    tattr["alt"] = xmlencode(imgalts[imgptr])
             res.append(qp.tag_info_to_xml(tname, ttype, tattr))
     return "".join(res)
 